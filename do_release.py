@@ -18,7 +18,8 @@ args = parser.parse_args()
 #TODO
 
 repo = Repo(".")
-reponame = list(repo.remotes.origin.urls)[0].split(':')[1].split('.')[0]
+url = next(iter(repo.remotes.origin.urls))
+reponame = url.rsplit(':', 1)[1].rsplit('.', 1)[0]
 if repo.is_dirty() and not args.dirtyoverride:
 	print("Cowardly refusing to do anything as the plugin repository is currently dirty.")
 	exit(-1)
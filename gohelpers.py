@@ -6,39 +6,77 @@ Copyright (c) 2017 Michael Rodler
 Licensed under MIT License, see LICENCE.
 """
 
+import contextlib
 import re
+import string
 import struct
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import binaryninja as bn
-from binaryninja.log import log_alert, log_debug, log_info, log_warn
+from binaryninja.log import log_alert, log_debug, log_info
 
-_RE_REPLACE_UNDERSCORE = re.compile("[^a-zA-Z0-9\.]")
-_RE_COMPRESS_UNDERSCORE = re.compile("__+")
+# '_' is not in the allowed set, so runs of underscores are compressed too
+_RE_SANITIZE = re.compile(r"[^a-zA-Z0-9.]+")
+# the characters _RE_SANITIZE leaves alone
+_VAR_NAME_CHARS = (string.ascii_letters + string.digits + ".").encode("ascii")
 
 GOFUNC_PREFIX = "go."
+# shortest function name that is used, same as the default of
+# bv.get_ascii_string_at
+GOFUNC_MIN_NAME_LEN = 4
+
+# .gopclntab header magic of the different go versions; only the go1.2 table
+# layout is supported for now
+GOPCLNTAB_MAGIC_12 = b"\xfb\xff\xff\xff\x00\x00"
+GOPCLNTAB_MAGICS = {
+    GOPCLNTAB_MAGIC_12: "1.2",
+    b"\xfa\xff\xff\xff\x00\x00": "1.16",
+    b"\xf0\xff\xff\xff\x00\x00": "1.18",
+    b"\xf1\xff\xff\xff\x00\x00": "1.20",
+}
+# where to look for the .gopclntab if there is no section of that name
+GOPCLNTAB_SEARCH_SECTIONS = (".rodata", ".rdata", ".data.rel.ro", ".text",
+                             "__gopclntab", "__rodata")
+
+_GOFUNC_STRIP = str.maketrans("", "", " ")
+# _GOFUNC_STRIP = str.maketrans(";,", "__", " ")
 
 # log_debug = log_info
+# log every single .gopclntab entry; formatting these messages is not free
+_DEBUG = False
 
 
 def santize_gofunc_name(name):
-    name = name.replace(" ", "")
-    # name = name.replace(";", "_")
-    # name = name.replace(",", "_")
-    return name
+    if " " not in name:
+        return name
+    return name.translate(_GOFUNC_STRIP)
 
 
+@lru_cache(maxsize=None)
 def sanitize_var_name(name):
-    varname = _RE_REPLACE_UNDERSCORE.sub("_", name)
-    varname = _RE_COMPRESS_UNDERSCORE.sub("_", varname)
-    return varname
+    # most names are already clean, skip the regex for those
+    if (name.isascii()
+            and not name.encode("ascii").translate(None, _VAR_NAME_CHARS)):
+        return name
+    return _RE_SANITIZE.sub("_", name)
 
 
 class GoHelper(bn.plugin.BackgroundTaskThread):
     def __init__(self, bv):
         bn.plugin.BackgroundTaskThread.__init__(self, "Go Loader Helper", True)
         self.bv = bv
-        self.br = bn.binaryview.BinaryReader(bv)
         self.ptr_size = bv.platform.arch.address_size
+        # struct byte order prefix matching the view
+        self._endian = (">" if bv.endianness == bn.Endianness.BigEndian
+                        else "<")
+        self._ptr_struct = struct.Struct(
+            self._endian + ("Q" if self.ptr_size == 8 else "I"))
+        self._u32_struct = struct.Struct(self._endian + "I")
 
     def get_section_by_name(self, section_name):
         if section_name in self.bv.sections:
@@ -48,97 +86,238 @@ class GoHelper(bn.plugin.BackgroundTaskThread):
 
     def get_pointer_at_virt(self, addr, size=None):
         x = self.bv.read(addr, self.ptr_size)
-        if len(x) == 8:
-            return struct.unpack("Q", x)[0]
-        elif len(x) == 4:
-            return struct.unpack("I", x)[0]
-        else:
+        if len(x) != self.ptr_size:
             raise ValueError("Invalid size {} for pointer; data: {!r}"
                              .format(len(x), x))
+        return self._ptr_struct.unpack(x)[0]
+
+    def bulk_modify_symbols(self):
+        # not available in older binaryninja versions
+        bulk = getattr(self.bv, "bulk_modify_symbols", None)
+        if bulk is None:
+            return contextlib.nullcontext()
+        return bulk()
+
+    @contextlib.contextmanager
+    def undoable_transaction(self):
+        # not available in older binaryninja versions
+        transaction = getattr(self.bv, "undoable_transaction", None)
+        if transaction is not None:
+            with transaction():
+                yield
+            return
+
+        self.bv.begin_undo_actions()
+        try:
+            yield
+        except BaseException:
+            # don't leave a partial batch behind as a single undo step, if
+            # this binaryninja version allows dropping it
+            revert = getattr(self.bv, "revert_undo_actions", None)
+            if revert is not None:
+                revert()
+            else:
+                self.bv.commit_undo_actions()
+            raise
+        self.bv.commit_undo_actions()
 
-    def get_pointer_at(self, at_addr, size=None):
-        self.br.seek(at_addr)
-        if size is None:
-            size = self.ptr_size
+    def define_user_symbols(self, syms):
+        define_all = getattr(self.bv, "define_user_symbols", None)
+        if define_all is not None:
+            define_all(syms)
+            return
 
-        if size == 8:
-            return self.br.read64()
-        elif size == 4:
-            return self.br.read32()
-        else:
-            raise ValueError("Unsupported ptr_size: {!r}".format(size))
+        define = self.bv.define_user_symbol
+        with self.bulk_modify_symbols():
+            for sym in syms:
+                define(sym)
 
     def get_function_around(self, addr):
-        bbl = self.bv.get_basic_blocks_at(addr)
-        if not bbl:
-            return None
-        bb = bbl[0]
-        if not bb:
+        fns = self.bv.get_functions_containing(addr)
+        if not fns:
             return None
-        return bb.function
+        return fns[0]
 
 
 class FunctionRenamer(GoHelper):
+    def _ptr(self, off):
+        return self._ptr_struct.unpack_from(self._pclntab_buf, off)[0]
+
+    def _find_pclntab_header(self, data, magic):
+        """
+        Find the first occurrence of magic in data that is followed by a
+        plausible header (zero padding, valid pc quantum and pointer size).
+        Returns the offset or -1.
+        """
+        off = data.find(magic)
+        while off != -1:
+            header = data[off:off + 8]
+            if (len(header) == 8 and header[4] == 0 and header[5] == 0
+                    and header[6] in (1, 2, 4)
+                    and header[7] == self.ptr_size):
+                return off
+            off = data.find(magic, off + 1)
+        return -1
+
+    def find_gopclntab(self):
+        """
+        Search for the .gopclntab header in the sections it is usually placed
+        in. Returns the address of the table together with the data up to the
+        end of the containing section, or None if nothing was found. A go1.2
+        table is preferred; tables of newer go versions are only returned if
+        there is none.
+        """
+        unsupported = None
+        for section_name in GOPCLNTAB_SEARCH_SECTIONS:
+            section = self.get_section_by_name(section_name)
+            if section is None:
+                continue
+            data = self.bv.read(section.start, section.length)
+            for magic in GOPCLNTAB_MAGICS:
+                off = self._find_pclntab_header(data, magic)
+                if off == -1:
+                    continue
+                if magic == GOPCLNTAB_MAGIC_12:
+                    return section.start + off, data[off:]
+                if unsupported is None:
+                    unsupported = section.start + off, data[off:]
+
+        # no usable sections, e.g. in a raw view
+        base_addr = self.bv.find_next_data(0, GOPCLNTAB_MAGIC_12)
+        while base_addr is not None:
+            if self._find_pclntab_header(self.bv.read(base_addr, 8),
+                                         GOPCLNTAB_MAGIC_12) == 0:
+                segment = self.bv.get_segment_at(base_addr)
+                end_addr = segment.end if segment else self.bv.end
+                return base_addr, self.bv.read(base_addr,
+                                               end_addr - base_addr)
+            base_addr = self.bv.find_next_data(base_addr + 1,
+                                               GOPCLNTAB_MAGIC_12)
+        return unsupported
+
     def rename_functions(self):
-        renamed = 0
         log_info("renaming functions based on .gopclntab section")
 
         gopclntab = self.get_section_by_name(".gopclntab")
 
         if gopclntab is None:
-            pattern = b"\xfb\xff\xff\xff\x00\x00"
-            base_addr = self.bv.find_next_data(0, pattern)
-
-            if base_addr is None:
+            located = self.find_gopclntab()
+            if located is None:
                 log_alert("Failed to find section '.gopclntab'")
                 return
+            base_addr, self._pclntab_buf = located
         else:
             base_addr = gopclntab.start
+            # snapshot the whole pclntab once; all table and name offset
+            # lookups are served from this buffer instead of the view
+            self._pclntab_buf = self.bv.read(base_addr, gopclntab.length)
+
+        magic = self._pclntab_buf[:len(GOPCLNTAB_MAGIC_12)]
+        if magic in GOPCLNTAB_MAGICS and magic != GOPCLNTAB_MAGIC_12:
+            log_alert("Unsupported .gopclntab format of go {} at 0x{:x}"
+                      .format(GOPCLNTAB_MAGICS[magic], base_addr))
+            return
 
-        size_addr = base_addr + 8
-        size = self.get_pointer_at(size_addr)
+        pclntab_buf = self._pclntab_buf
+        buf_len = len(pclntab_buf)
+        if buf_len < 8 + self.ptr_size:
+            log_alert("Failed to read .gopclntab at 0x{:x}".format(base_addr))
+            return
+
+        size_off = 8
+        size = self._ptr(size_off)
 
         log_info("found .gopclntab section at 0x{:x} with {} entries"
                  .format(base_addr, size / (self.ptr_size * 2)))
 
-        start_addr = size_addr + self.ptr_size
-        end_addr = base_addr + (size * self.ptr_size * 2)
-
-        for addr in range(start_addr, end_addr, (2 * self.ptr_size)):
-            log_debug("analyzing at 0x{:x}".format(addr))
-            func_addr = self.get_pointer_at(addr)
-            entry_offset = self.get_pointer_at(addr + self.ptr_size)
+        # the table holds size (func_addr, entry_offset) pairs right after
+        # the header; only entries that are fully inside the buffer are used
+        entry_size = 2 * self.ptr_size
+        start_off = size_off + self.ptr_size
+        end_off = min(start_off + size * entry_size, buf_len)
 
-            log_debug("func_addr 0x{:x}, entry offset 0x{:x}"
-                      .format(func_addr, entry_offset))
+        n_entries = max(0, (end_off - start_off) // entry_size)
 
-            name_str_offset = self.get_pointer_at(
-                base_addr + entry_offset + self.ptr_size, 4)
+        if np is not None:
+            # decode the whole table in one go; tolist() hands out plain ints
+            entries = np.frombuffer(
+                pclntab_buf,
+                dtype=self._endian + ("u8" if self.ptr_size == 8 else "u4"),
+                count=2 * n_entries, offset=start_off).reshape(-1, 2).tolist()
+        else:
+            functab = pclntab_buf[start_off:start_off + n_entries * entry_size]
+            entries = struct.iter_unpack(
+                self._endian + ("QQ" if self.ptr_size == 8 else "II"),
+                functab)
+
+        # hoist attribute lookups out of the loops below
+        ptr_size = self.ptr_size
+        unpack_u32 = self._u32_struct.unpack_from
+        find_in_buf = pclntab_buf.find
+        get_str = self.bv.get_ascii_string_at
+
+        found = []
+        for i, (func_addr, entry_offset) in enumerate(entries):
+            addr = base_addr + start_off + i * entry_size
+            if _DEBUG:
+                log_debug("analyzing at 0x{:x}".format(addr))
+                log_debug("func_addr 0x{:x}, entry offset 0x{:x}"
+                          .format(func_addr, entry_offset))
+
+            name_off_pos = entry_offset + ptr_size
+            if name_off_pos + 4 > buf_len:
+                continue
+            name_str_offset = unpack_u32(pclntab_buf, name_off_pos)[0]
             name_addr = base_addr + name_str_offset
 
-            name = self.bv.get_ascii_string_at(name_addr)
+            # the names normally live inside the pclntab as well, so slice
+            # them out of the buffer and only fall back to the view for
+            # names outside of it
+            name = None
+            if name_str_offset < buf_len:
+                name_end = find_in_buf(b"\x00", name_str_offset)
+                if name_end != -1:
+                    # short names are not used anyway, don't decode those
+                    if name_end - name_str_offset < GOFUNC_MIN_NAME_LEN:
+                        continue
+                    name = pclntab_buf[name_str_offset:name_end]
+                    # same rules as for names read through the view
+                    if not name.isascii():
+                        continue
+                    name = name.decode("ascii")
+            if name is None:
+                name = get_str(name_addr, min_length=GOFUNC_MIN_NAME_LEN)
+                if name:
+                    name = name.value
             if not name:
                 continue
-            name=name.value
 
-            log_debug("found name '{}' for address 0x{:x}"
-                      .format(name, func_addr))
+            if _DEBUG:
+                log_debug("found name '{}' for address 0x{:x}"
+                          .format(name, func_addr))
 
-            func = self.bv.get_function_at(func_addr)
-            if not func:
-                func = self.bv.create_user_function(func_addr)
+            found.append((func_addr,
+                          GOFUNC_PREFIX + santize_gofunc_name(name)))
 
-            if name and len(name) > 2:
-                name = GOFUNC_PREFIX + santize_gofunc_name(name)
-                sym = bn.types.Symbol('FunctionSymbol', func_addr, name, name)
-                self.bv.define_user_symbol(sym)
-                renamed += 1
-            else:
-                log_warn(("not using function name {!r} for function at 0x{:x}"
-                          " in .gopclntab addr 0x{:x} name addr 0x{:x}")
-                         .format(name, func_addr, addr, name_addr))
+        # one pass over the existing functions instead of a lookup per entry
+        known_funcs = {f.start for f in self.bv.functions}
+
+        # only modify the view once the whole table has been parsed, and do
+        # so as a single undo action
+        create_func = self.bv.create_user_function
+        Symbol = bn.types.Symbol
+
+        with self.undoable_transaction():
+            syms = []
+            for func_addr, name in found:
+                if func_addr not in known_funcs:
+                    create_func(func_addr)
+                    known_funcs.add(func_addr)
 
-        log_info("renamed {} go functions".format(renamed))
+                syms.append(Symbol('FunctionSymbol', func_addr, name, name))
+            self.define_user_symbols(syms)
+
+        log_info("renamed {} go functions".format(len(syms)))
 
     def run(self):
         self.rename_functions()
@@ -152,31 +331,31 @@ def rename_functions(bv):
 # FIXME: this one doesn't work as expected... :S
 class NewProcRenamer(GoHelper):
     def rename(self):
-        renamed = 0
+        fptrs = []
         newprocfn = self.bv.get_symbol_by_raw_name("go.runtime.newproc")
+        if newprocfn is None:
+            log_alert("Failed to find 'go.runtime.newproc'")
+            return
         xrefs = self.bv.get_code_refs(newprocfn.address)
         for xref in xrefs:
             log_info("found xref at 0x{:x}".format(xref.address))
             addr = xref.address
             fn = self.get_function_around(addr)
+            if fn is None:
+                continue
             callinst = fn.get_low_level_il_at(addr)
+            if callinst is None:
+                continue
             if callinst.operation != bn.LowLevelILOperation.LLIL_CALL:
                 log_debug("not a call instruction {!r}".format(callinst))
                 continue
-            params = []
-            # FIXME: this is such a dirty hack
-            # get the previous two LIL instruction
-            j = 1
-            while len(params) < 2:
-                for i in range(1, 7):
-                    try:
-                        j += 1
-                        inst = fn.get_low_level_il_at(addr - j)
-                        log_debug("instruction: -{} {!r}".format(j, inst))
-                        break
-                    except IndexError:
-                        continue
-                params.append(inst)
+            # get the previous two LLIL instructions, closest one first
+            idx = callinst.instr_index
+            if idx < 2:
+                continue
+            ilfn = fn.low_level_il
+            params = [ilfn[idx - 1], ilfn[idx - 2]]
+            log_debug("instructions: {!r}".format(params))
 
             # FIXME: does this work on non-x86?
             # check if 2 push instructions
@@ -201,14 +380,19 @@ class NewProcRenamer(GoHelper):
                 if tfn:
                     varname = "fptr_"
                     varname += sanitize_var_name(tfn.name)
-                    t = self.bv.parse_type_string("void*")
+                    fptrs.append((a, varname))
+
+        if fptrs:
+            t = self.bv.parse_type_string("void*")
+            with self.undoable_transaction():
+                for a, _ in fptrs:
                     self.bv.define_user_data_var(a, t[0])
-                    sym = bn.types.Symbol('DataSymbol', a, varname, varname)
-                    self.bv.define_user_symbol(sym)
-                    renamed += 1
+                self.define_user_symbols(
+                    [bn.types.Symbol('DataSymbol', a, varname, varname)
+                     for a, varname in fptrs])
 
         log_info("renamed {} function pointers, passed to newproc"
-                 .format(renamed))
+                 .format(len(fptrs)))
 
     def run(self):
         self.rename()